@@ -1,71 +1,100 @@
 import argparse
+import hashlib
+import multiprocessing
 import sys
 import warnings
+from functools import partial
 from glob import glob
+from typing import List, Tuple
 
 import numpy as np
+import torch
 import yaml
 from tqdm import tqdm
 
 sys.path.append('../')
 from utils.attribute_hashmap import AttributeHashmap
 from utils.diffusion_condensation import get_persistent_structures
-from utils.metrics import dice_coeff, ergas, guided_relabel, hausdorff, per_class_dice_coeff, per_class_hausdorff, \
-    range_aware_ssim, rmse
+from utils.metrics import dice_coeff, densify_label, guided_relabel, hausdorff, per_class_dice_coeff, per_class_hausdorff, \
+    range_aware_ssim_batch, rmse_ergas
 from utils.parse import parse_settings
 from utils.segmentation import label_hint_seg
 
 warnings.filterwarnings("ignore")
 
 
+def fits_int16(label: np.array) -> bool:
+    return np.issubdtype(label.dtype, np.integer) and label.size > 0 \
+        and label.min() >= 0 and label.max() <= np.iinfo(np.int16).max
+
+
+def downcast_labels(hashmap: dict) -> dict:
+    '''
+    Store wide integer labels (typically int64) as int16 when the values fit,
+    so that the metrics move less memory. Other arrays are kept as is.
+
+    `guided_relabel` writes `label_true` indices into arrays of the prediction
+    dtype, so predictions are only downcast if `label_true` fits as well.
+    '''
+    if 'label_true' not in hashmap.keys() \
+            or not fits_int16(hashmap['label_true']):
+        return hashmap
+
+    for key, label in hashmap.items():
+        if label.dtype.itemsize > 2 and fits_int16(label):
+            hashmap[key] = label.astype(np.int16)
+    return hashmap
+
+
+# NOTE: Each array in an .npz file is decompressed on access.
+# Only read the arrays needed for the metrics (e.g., skip `image` and `latent`).
 def load_baselines(path: str) -> dict:
-    numpy_array = np.load(path)
     hashmap = {}
-    hashmap['image'] = numpy_array['image']
-    hashmap['label_true'] = numpy_array['label']
-    hashmap['label_random'] = numpy_array['label_random']
-    hashmap['label_watershed'] = numpy_array['label_watershed']
-    hashmap['label_felzenszwalb'] = numpy_array['label_felzenszwalb']
+    with np.load(path) as numpy_array:
+        hashmap['label_true'] = numpy_array['label']
+        hashmap['label_random'] = numpy_array['label_random']
+        hashmap['label_watershed'] = numpy_array['label_watershed']
+        hashmap['label_felzenszwalb'] = numpy_array['label_felzenszwalb']
     return hashmap
 
 
 def load_kmeans(path: str) -> dict:
-    numpy_array = np.load(path)
     hashmap = {}
-    hashmap['image'] = numpy_array['image']
-    hashmap['label_true'] = numpy_array['label']
-    hashmap['latent'] = numpy_array['latent']
-    hashmap['label_kmeans'] = numpy_array['label_kmeans']
+    with np.load(path) as numpy_array:
+        hashmap['label_true'] = numpy_array['label']
+        hashmap['label_kmeans'] = numpy_array['label_kmeans']
     return hashmap
 
 
 def load_diffusion(path: str) -> dict:
-    numpy_array = np.load(path)
     hashmap = {}
-    hashmap['image'] = numpy_array['image']
-    hashmap['recon'] = numpy_array['recon']
-    hashmap['label_true'] = numpy_array['label']
-    hashmap['latent'] = numpy_array['latent']
-    hashmap['granularities_diffusion'] = numpy_array['granularities_diffusion']
-    hashmap['labels_diffusion'] = numpy_array['labels_diffusion']
+    with np.load(path) as numpy_array:
+        hashmap['label_true'] = numpy_array['label']
+        hashmap['labels_diffusion'] = numpy_array['labels_diffusion']
     return hashmap
 
 
 def load_stego(path: str) -> dict:
-    numpy_array = np.load(path)
     hashmap = {}
-    hashmap['seg_stego'] = numpy_array['seg_stego']
-    hashmap['label_stego'] = numpy_array['label_stego']
+    with np.load(path) as numpy_array:
+        hashmap['seg_stego'] = numpy_array['seg_stego']
+        hashmap['label_stego'] = numpy_array['label_stego']
     return hashmap
 
 
-def combine_hashmaps(*args: dict) -> dict:
-    combined = {}
-    for hashmap in args:
-        for k in hashmap.keys():
-            if k not in combined.keys():
-                combined[k] = hashmap[k]
-    return combined
+def array_digest(array: np.array) -> bytes:
+    '''
+    Digest of the values, dtype and shape of `array`.
+    Integer labels are widened first, such that equal labels stored with
+    different dtypes (e.g., uint8 and int64) share the same digest.
+    '''
+    if np.issubdtype(array.dtype, np.integer) or array.dtype == bool:
+        array = array.astype(np.int64)
+    hasher = hashlib.blake2b(digest_size=8)
+    hasher.update(array.dtype.str.encode())
+    hasher.update(str(array.shape).encode())
+    hasher.update(array.tobytes())
+    return hasher.digest()
 
 
 def segment(hashmap: dict, label_name: str = 'kmeans') -> dict:
@@ -115,46 +144,300 @@ def persistent_structures(hashmap: dict) -> dict:
     return hashmap
 
 
-# def metric_permuted_label(fn, mode: str, permutee: np.array,
-#                           other_array: np.array) -> List[np.array]:
-#     '''
-#     Return the (min or max) metric:
-#         fn(permutee, other_array)
-#     as we permute the label indices of `permutee`.
+def new_running_stats() -> dict:
+    return {
+        'count': 0,
+        'mean': 0.0,
+        'M2': 0.0,
+        'nan': 0,
+        'posinf': 0,
+        'neginf': 0
+    }
 
-#     NOTE: Nice try. But it takes too long as it runs each metric several million times.
-#     '''
-#     indices_from = sorted(list(set(np.unique(permutee)) - set([0])))
 
-#     assert mode in ['min', 'max']
+def update_running_stats(running_stats: dict, value: float) -> None:
+    '''
+    Welford's online algorithm over the finite values.
+    `M2` is the running sum of squared deviations from the mean.
+
+    Non-finite values (e.g., inf Hausdorff or ERGAS) would turn `mean` and `M2`
+    into nan for good, so they are only counted, and handled in `mean_and_sem`.
+    '''
+    if np.isnan(value):
+        running_stats['nan'] += 1
+    elif value == np.inf:
+        running_stats['posinf'] += 1
+    elif value == -np.inf:
+        running_stats['neginf'] += 1
+    else:
+        running_stats['count'] += 1
+        delta = value - running_stats['mean']
+        running_stats['mean'] += delta / running_stats['count']
+        running_stats['M2'] += delta * (value - running_stats['mean'])
+
+
+def mean_and_sem(running_stats_list: List[dict]) -> Tuple[np.array, np.array]:
+    '''
+    Mean and standard error of the mean (same as np.std(...) / np.sqrt(n)),
+    computed for all running statistics in the list at once.
+
+    Follows `np.mean` and `np.std` for non-finite values: any nan (or both
+    +inf and -inf) gives a nan mean, otherwise any inf gives an inf mean,
+    and any non-finite value gives a nan standard deviation.
+    '''
+    count = np.array([item['count'] for item in running_stats_list])
+    mean = np.array([item['mean'] for item in running_stats_list])
+    M2 = np.array([item['M2'] for item in running_stats_list])
+    nan = np.array([item['nan'] for item in running_stats_list])
+    posinf = np.array([item['posinf'] for item in running_stats_list])
+    neginf = np.array([item['neginf'] for item in running_stats_list])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(count > 0, mean, np.nan)
+        sem = np.sqrt(M2 / count) / np.sqrt(count)
+
+    mean = np.where(posinf > 0, np.inf, mean)
+    mean = np.where(neginf > 0, -np.inf, mean)
+    mean = np.where((nan > 0) | ((posinf > 0) & (neginf > 0)), np.nan, mean)
+    sem = np.where(nan + posinf + neginf > 0, np.nan, sem)
+    return mean, sem
+
+
+def crop_to_foreground(label_true: np.array,
+                       label_pred: np.array) -> Tuple[np.array, np.array]:
+    '''
+    Crop both binary labels to the bounding box of their union foreground.
+
+    Dice coefficient and Hausdorff distance only look at foreground pixels,
+    so they are unchanged by the crop. SSIM, ERGAS and RMSE average over the
+    background as well, so they shall be computed on the full image.
+
+    If either label is empty, nothing is cropped, such that `hausdorff`
+    still sees the full image size for its special case.
+    '''
+    if not label_true.any() or not label_pred.any():
+        return label_true, label_pred
+
+    foreground = np.logical_or(label_true, label_pred)
+    rows = np.flatnonzero(foreground.any(axis=1))
+    cols = np.flatnonzero(foreground.any(axis=0))
+    bbox = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+
+    return label_true[bbox], label_pred[bbox]
+
+
+def evaluate_image(image_idx: int,
+                   is_binary: bool,
+                   entity_tuples: List[Tuple[str]],
+                   np_files_paths: dict,
+                   device: str = 'cpu') -> dict:
+    '''
+    Compute every metric for every entry in `entity_tuples` on a single image.
+    Returns a nested dict: image_metrics[metric_name][entry] = value.
+
+    `device`: where SSIM is computed. The other metrics always run on CPU.
+    '''
+    has_baselines = len(np_files_paths['baselines']) > 0
+    has_kmeans = len(np_files_paths['kmeans']) > 0
+    has_diffusion = len(np_files_paths['diffusion']) > 0
+    has_stego = len(np_files_paths['stego']) > 0
+
+    image_metrics = {
+        metric_name: {}
+        for metric_name in ['dice', 'hausdorff', 'ssim', 'ergas', 'rmse']
+    }
 
-#     if mode == 'min':
-#         best_metric = np.inf
-#     elif mode == 'max':
-#         best_metric = -np.inf
+    baselines_hashmap, kmeans_hashmap, diffusion_hashmap, stego_hashmap = {}, {}, {}, {}
+    if has_baselines:
+        baselines_hashmap = load_baselines(
+            np_files_paths['baselines'][image_idx])
+    if has_kmeans:
+        kmeans_hashmap = load_kmeans(np_files_paths['kmeans'][image_idx])
+    if has_diffusion:
+        diffusion_hashmap = load_diffusion(
+            np_files_paths['diffusion'][image_idx])
+    if has_stego:
+        stego_hashmap = load_stego(np_files_paths['stego'][image_idx])
+
+    if __debug__:
+        # Sanity check that all sources refer to the same image.
+        # Comparing digests avoids pairwise full-image comparisons.
+        sources = {
+            'baselines': baselines_hashmap,
+            'kmeans': kmeans_hashmap,
+            'diffusion': diffusion_hashmap
+        }
+        label_true_digests = set([
+            array_digest(source['label_true'])
+            for source in sources.values() if 'label_true' in source.keys()
+        ])
+        assert len(label_true_digests) <= 1, \
+            'Image %d: `label` differs among %s.' % (image_idx, [
+                np_files_paths[source_name][image_idx]
+                for source_name in sources.keys()
+                if 'label_true' in sources[source_name].keys()
+            ])
 
-#     for indices_to in itertools.permutations(indices_from):
-#         permuted = np.zeros_like(permutee)
-#         assert len(indices_from) == len(indices_to)
-#         for (i, j) in zip(indices_from, indices_to):
-#             permuted[permutee == i] = j
+    # Shared keys (e.g., `label_true`) are taken from the earliest source.
+    hashmap = {
+        **stego_hashmap,
+        **diffusion_hashmap,
+        **kmeans_hashmap,
+        **baselines_hashmap
+    }
+    hashmap = downcast_labels(hashmap)
 
-#         metric = fn(permuted, other_array)
-#         if mode == 'min':
-#             best_metric = min(best_metric, metric)
-#         elif mode == 'max':
-#             best_metric = max(best_metric, metric)
+    if has_kmeans:
+        hashmap = segment(hashmap, label_name='kmeans')
+    if has_diffusion:
+        hashmap = persistent_structures(hashmap)
+        hashmap = segment(hashmap, label_name='diffusion-persistent')
+        hashmap = segment_every_diffusion(hashmap)
+
+    # Re-label the label indices for multi-class labels.
+    # `guided_relabel` matches each label index using the confusion matrix,
+    # instead of searching over all (K!) permutations of the label indices.
+    # This is done once per prediction, in place, so that every metric
+    # below reuses the same relabeled array.
+    if not is_binary:
+        # All predictions are matched against the same `label_true`.
+        label_true_dense = densify_label(hashmap['label_true'])
+        # Relabel each of the diffusion labels.
+        if has_diffusion:
+            for i in range(hashmap['labels_diffusion'].shape[0]):
+                hashmap['labels_diffusion'][i, ...] = guided_relabel(
+                    label_pred=hashmap['labels_diffusion'][i, ...],
+                    label_true=hashmap['label_true'],
+                    label_true_dense=label_true_dense)
+        # Relabel all the other predicted labels.
+        for (_, _, p2) in entity_tuples:
+            if p2 not in hashmap.keys():
+                continue
+            else:
+                hashmap[p2] = guided_relabel(
+                    label_pred=hashmap[p2],
+                    label_true=hashmap['label_true'],
+                    label_true_dense=label_true_dense)
+
+    for (entry, p1, p2) in entity_tuples:
+        if p2 == 'label_diffusion-best':
+            # Get the best among all diffusion labels.
+            assert not is_binary
+            image_metrics['dice'][entry] = max([
+                per_class_dice_coeff(
+                    label_true=hashmap['label_true'],
+                    label_pred=hashmap['labels_diffusion'][i, ...])
+                for i in range(hashmap['labels_diffusion'].shape[0])
+            ])
+            image_metrics['hausdorff'][entry] = min([
+                per_class_hausdorff(
+                    label_true=hashmap['label_true'],
+                    label_pred=hashmap['labels_diffusion'][i, ...])
+                for i in range(hashmap['labels_diffusion'].shape[0])
+            ])
+            image_metrics['ssim'][entry] = max(
+                range_aware_ssim_batch(
+                    label_true=hashmap['label_true'],
+                    labels_pred=hashmap['labels_diffusion'],
+                    device=device))
+            rmse_ergas_pairs = [
+                rmse_ergas(hashmap['label_true'],
+                           hashmap['labels_diffusion'][i, ...])
+                for i in range(hashmap['labels_diffusion'].shape[0])
+            ]
+            image_metrics['ergas'][entry] = min(
+                [ergas for (_, ergas) in rmse_ergas_pairs])
+            image_metrics['rmse'][entry] = min(
+                [rmse for (rmse, _) in rmse_ergas_pairs])
+        elif p2 == 'seg_diffusion-best':
+            # Get the best among all diffusion segmentations.
+            assert is_binary
+            cropped_pairs = [
+                crop_to_foreground(
+                    label_true=hashmap['label_true'],
+                    label_pred=hashmap['segs_diffusion'][i, ...])
+                for i in range(hashmap['segs_diffusion'].shape[0])
+            ]
+            image_metrics['dice'][entry] = max([
+                dice_coeff(label_true=label_true, label_pred=label_pred)
+                for (label_true, label_pred) in cropped_pairs
+            ])
+            image_metrics['hausdorff'][entry] = min([
+                hausdorff(label_true=label_true, label_pred=label_pred)
+                for (label_true, label_pred) in cropped_pairs
+            ])
+            image_metrics['ssim'][entry] = max(
+                range_aware_ssim_batch(
+                    label_true=hashmap['label_true'],
+                    labels_pred=hashmap['segs_diffusion'],
+                    device=device))
+            rmse_ergas_pairs = [
+                rmse_ergas(hashmap['label_true'],
+                           hashmap['segs_diffusion'][i, ...])
+                for i in range(hashmap['segs_diffusion'].shape[0])
+            ]
+            image_metrics['ergas'][entry] = min(
+                [ergas for (_, ergas) in rmse_ergas_pairs])
+            image_metrics['rmse'][entry] = min(
+                [rmse for (rmse, _) in rmse_ergas_pairs])
+        elif p2 not in hashmap.keys():
+            # nan-padding for unavailable measurements.
+            image_metrics['dice'][entry] = np.nan
+            image_metrics['hausdorff'][entry] = np.nan
+            image_metrics['ssim'][entry] = np.nan
+            image_metrics['ergas'][entry] = np.nan
+            image_metrics['rmse'][entry] = np.nan
+        else:
+            if is_binary:
+                label_true, label_pred = crop_to_foreground(
+                    label_true=hashmap[p1], label_pred=hashmap[p2])
+                image_metrics['dice'][entry] = dice_coeff(
+                    label_true=label_true, label_pred=label_pred)
+                image_metrics['hausdorff'][entry] = hausdorff(
+                    label_true=label_true, label_pred=label_pred)
+            else:
+                image_metrics['dice'][entry] = per_class_dice_coeff(
+                    label_true=hashmap[p1], label_pred=hashmap[p2])
+                image_metrics['hausdorff'][entry] = per_class_hausdorff(
+                    label_true=hashmap[p1], label_pred=hashmap[p2])
+            image_metrics['ssim'][entry] = range_aware_ssim_batch(
+                label_true=hashmap[p1],
+                labels_pred=hashmap[p2][None, ...],
+                device=device)[0]
+            rmse_value, ergas_value = rmse_ergas(hashmap[p1], hashmap[p2])
+            image_metrics['ergas'][entry] = ergas_value
+            image_metrics['rmse'][entry] = rmse_value
+
+    return image_metrics
 
-#     return best_metric
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config',
                         help='Path to config yaml file.',
                         required=True)
+    parser.add_argument(
+        '--num-workers',
+        help='Number of processes evaluating images in parallel. ' + \
+            'Defaults to the number of CPUs, or 1 if `--device` is a GPU.',
+        type=int,
+        default=None)
+    parser.add_argument(
+        '--device',
+        help='Device for computing SSIM, e.g., `cpu` or `cuda`. ' + \
+            'Falls back to `cpu` if CUDA is unavailable.',
+        default='cpu')
     args = vars(parser.parse_args())
     args = AttributeHashmap(args)
 
+    if args.device.startswith('cuda') and not torch.cuda.is_available():
+        print('CUDA is unavailable. Computing SSIM on CPU instead.')
+        args.device = 'cpu'
+
+    if args.num_workers is None and args.device != 'cpu':
+        # Each process holds its own CUDA context on the same GPU.
+        args.num_workers = 1
+
     config = AttributeHashmap(yaml.safe_load(open(args.config)))
     config.config_file_name = args.config
     config = parse_settings(config, log_settings=False)
@@ -248,186 +531,46 @@ if __name__ == '__main__':
                  'label_diffusion-best'),
             ])
 
+    # Running statistics, such that we do not need to keep every value.
     metrics = {
-        'dice': {tup[0]: []
-                 for tup in entity_tuples},
-        'hausdorff': {tup[0]: []
-                      for tup in entity_tuples},
-        'ssim': {tup[0]: []
-                 for tup in entity_tuples},
-        'ergas': {tup[0]: []
-                  for tup in entity_tuples},
-        'rmse': {tup[0]: []
-                 for tup in entity_tuples},
+        metric_name: {tup[0]: new_running_stats()
+                      for tup in entity_tuples}
+        for metric_name in ['dice', 'hausdorff', 'ssim', 'ergas', 'rmse']
     }
 
-    for image_idx in tqdm(range(num_files)):
-        baselines_hashmap, kmeans_hashmap, diffusion_hashmap, stego_hashmap = {}, {}, {}, {}
-        if has_baselines:
-            baselines_hashmap = load_baselines(
-                np_files_path_baselines[image_idx])
-        if has_kmeans:
-            kmeans_hashmap = load_kmeans(np_files_path_kmeans[image_idx])
-        if has_diffusion:
-            diffusion_hashmap = load_diffusion(
-                np_files_path_diffusion[image_idx])
-        if has_stego:
-            stego_hashmap = load_stego(np_files_path_stego[image_idx])
-
-        hashmap = combine_hashmaps(baselines_hashmap, kmeans_hashmap,
-                                   diffusion_hashmap, stego_hashmap)
-
-        if has_kmeans:
-            hashmap = segment(hashmap, label_name='kmeans')
-        if has_diffusion:
-            hashmap = persistent_structures(hashmap)
-            hashmap = segment(hashmap, label_name='diffusion-persistent')
-            hashmap = segment_every_diffusion(hashmap)
-
-        # Re-label the label indices for multi-class labels.
-        if not hparams.is_binary:
-            # Relabel each of the diffusion labels.
-            if has_diffusion:
-                for i in range(hashmap['labels_diffusion'].shape[0]):
-                    hashmap['labels_diffusion'][i, ...] = guided_relabel(
-                        label_pred=hashmap['labels_diffusion'][i, ...],
-                        label_true=hashmap['label_true'])
-            # Relabel all the other predicted labels.
-            for (_, _, p2) in entity_tuples:
-                if p2 not in hashmap.keys():
-                    continue
-                else:
-                    hashmap[p2] = guided_relabel(
-                        label_pred=hashmap[p2],
-                        label_true=hashmap['label_true'])
-
-        for (entry, p1, p2) in entity_tuples:
-            if p2 == 'label_diffusion-best':
-                # Get the best among all diffusion labels.
-                assert not hparams.is_binary
-                metrics['dice'][entry].append(
-                    max([
-                        per_class_dice_coeff(
-                            label_true=hashmap['label_true'],
-                            label_pred=hashmap['labels_diffusion'][i, ...])
-                        for i in range(hashmap['labels_diffusion'].shape[0])
-                    ]))
-                metrics['hausdorff'][entry].append(
-                    min([
-                        per_class_hausdorff(
-                            label_true=hashmap['label_true'],
-                            label_pred=hashmap['labels_diffusion'][i, ...])
-                        for i in range(hashmap['labels_diffusion'].shape[0])
-                    ]))
-                metrics['ssim'][entry].append(
-                    max([
-                        range_aware_ssim(
-                            label_true=hashmap['label_true'],
-                            label_pred=hashmap['labels_diffusion'][i, ...])
-                        for i in range(hashmap['labels_diffusion'].shape[0])
-                    ]))
-                metrics['ergas'][entry].append(
-                    min([
-                        ergas(hashmap['label_true'],
-                              hashmap['labels_diffusion'][i, ...])
-                        for i in range(hashmap['labels_diffusion'].shape[0])
-                    ]))
-                metrics['rmse'][entry].append(
-                    min([
-                        rmse(hashmap['label_true'],
-                             hashmap['labels_diffusion'][i, ...])
-                        for i in range(hashmap['labels_diffusion'].shape[0])
-                    ]))
-            elif p2 == 'seg_diffusion-best':
-                # Get the best among all diffusion segmentations.
-                assert hparams.is_binary
-                metrics['dice'][entry].append(
-                    max([
-                        dice_coeff(label_true=hashmap['label_true'],
-                                   label_pred=hashmap['segs_diffusion'][i,
-                                                                        ...])
-                        for i in range(hashmap['segs_diffusion'].shape[0])
-                    ]))
-                metrics['hausdorff'][entry].append(
-                    min([
-                        hausdorff(label_true=hashmap['label_true'],
-                                  label_pred=hashmap['segs_diffusion'][i, ...])
-                        for i in range(hashmap['segs_diffusion'].shape[0])
-                    ]))
-                metrics['ssim'][entry].append(
-                    max([
-                        range_aware_ssim(
-                            label_true=hashmap['label_true'],
-                            label_pred=hashmap['segs_diffusion'][i, ...])
-                        for i in range(hashmap['segs_diffusion'].shape[0])
-                    ]))
-                metrics['ergas'][entry].append(
-                    min([
-                        ergas(hashmap['label_true'],
-                              hashmap['segs_diffusion'][i, ...])
-                        for i in range(hashmap['segs_diffusion'].shape[0])
-                    ]))
-                metrics['rmse'][entry].append(
-                    min([
-                        rmse(hashmap['label_true'],
-                             hashmap['segs_diffusion'][i, ...])
-                        for i in range(hashmap['segs_diffusion'].shape[0])
-                    ]))
-            elif p2 not in hashmap.keys():
-                # nan-padding for unavailable measurements.
-                metrics['dice'][entry].append(np.nan)
-                metrics['hausdorff'][entry].append(np.nan)
-                metrics['ssim'][entry].append(np.nan)
-                metrics['ergas'][entry].append(np.nan)
-                metrics['rmse'][entry].append(np.nan)
-            else:
-                if hparams.is_binary:
-                    metrics['dice'][entry].append(
-                        dice_coeff(label_true=hashmap[p1],
-                                   label_pred=hashmap[p2]))
-                    metrics['hausdorff'][entry].append(
-                        hausdorff(label_true=hashmap[p1],
-                                  label_pred=hashmap[p2]))
-                else:
-                    metrics['dice'][entry].append(
-                        per_class_dice_coeff(label_true=hashmap[p1],
-                                             label_pred=hashmap[p2]))
-                    metrics['hausdorff'][entry].append(
-                        per_class_hausdorff(label_true=hashmap[p1],
-                                            label_pred=hashmap[p2]))
-                metrics['ssim'][entry].append(
-                    range_aware_ssim(label_true=hashmap[p1],
-                                     label_pred=hashmap[p2]))
-                metrics['ergas'][entry].append(ergas(hashmap[p1], hashmap[p2]))
-                metrics['rmse'][entry].append(rmse(hashmap[p1], hashmap[p2]))
-
-    print('\n\nDice Coefficient')
-    for (entry, _, _) in entity_tuples:
-        print('%s: %.3f \u00B1 %.3f' % (entry, np.mean(
-            metrics['dice'][entry]), np.std(metrics['dice'][entry]) /
-                                        np.sqrt(len(metrics['dice'][entry]))))
-
-    print('\n\nHausdorff Distance')
-    for (entry, _, _) in entity_tuples:
-        print('%s: %.3f \u00B1 %.3f' %
-              (entry, np.mean(metrics['hausdorff'][entry]),
-               np.std(metrics['hausdorff'][entry]) /
-               np.sqrt(len(metrics['hausdorff'][entry]))))
-
-    print('\n\nSSIM')
-    for (entry, _, _) in entity_tuples:
-        print('%s: %.3f \u00B1 %.3f' % (entry, np.mean(
-            metrics['ssim'][entry]), np.std(metrics['ssim'][entry]) /
-                                        np.sqrt(len(metrics['ssim'][entry]))))
-
-    print('\n\nERGAS')
-    for (entry, _, _) in entity_tuples:
-        print('%s: %.3f \u00B1 %.3f' % (entry, np.mean(
-            metrics['ergas'][entry]), np.std(metrics['ergas'][entry]) /
-                                        np.sqrt(len(metrics['ergas'][entry]))))
-
-    print('\n\nRMSE')
-    for (entry, _, _) in entity_tuples:
-        print('%s: %.3f \u00B1 %.3f' % (entry, np.mean(
-            metrics['rmse'][entry]), np.std(metrics['rmse'][entry]) /
-                                        np.sqrt(len(metrics['rmse'][entry]))))
+    # Images are independent of each other, so evaluate them in parallel.
+    evaluate_fn = partial(evaluate_image,
+                          is_binary=hparams.is_binary,
+                          entity_tuples=entity_tuples,
+                          np_files_paths={
+                              'baselines': np_files_path_baselines,
+                              'kmeans': np_files_path_kmeans,
+                              'diffusion': np_files_path_diffusion,
+                              'stego': np_files_path_stego,
+                          },
+                          device=args.device)
+    # CUDA cannot be re-initialized in forked processes.
+    mp_context = multiprocessing.get_context(
+        'spawn' if args.device != 'cpu' else None)
+    with mp_context.Pool(args.num_workers) as pool:
+        for image_metrics in tqdm(pool.imap_unordered(evaluate_fn,
+                                                      range(num_files)),
+                                  total=num_files):
+            for metric_name in metrics.keys():
+                for (entry, _, _) in entity_tuples:
+                    update_running_stats(metrics[metric_name][entry],
+                                         image_metrics[metric_name][entry])
+
+    metric_titles = {
+        'dice': 'Dice Coefficient',
+        'hausdorff': 'Hausdorff Distance',
+        'ssim': 'SSIM',
+        'ergas': 'ERGAS',
+        'rmse': 'RMSE',
+    }
+    for metric_name, metric_title in metric_titles.items():
+        means, sems = mean_and_sem(
+            [metrics[metric_name][entry] for (entry, _, _) in entity_tuples])
+        print('\n\n%s' % metric_title)
+        for (entry, _, _), mean, sem in zip(entity_tuples, means, sems):
+            print('%s: %.3f \u00B1 %.3f' % (entry, mean, sem))
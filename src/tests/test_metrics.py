@@ -0,0 +1,63 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.metrics import range_aware_ssim_batch, ssim
+
+
+def skimage_ssim_list(label_true: np.array, labels_pred: np.array) -> np.array:
+    '''
+    Reference: skimage ssim on each prediction, without any fast path.
+    '''
+    data_range = label_true.max() - label_true.min()
+    return np.array([
+        ssim(a=label_true, b=label_pred, data_range=data_range)
+        for label_pred in labels_pred
+    ])
+
+
+def make_labels(H: int,
+                W: int,
+                K: int,
+                dtype: type,
+                B: int = 4,
+                seed: int = 0):
+    rng = np.random.default_rng(seed)
+    label_true = rng.integers(0, K, (H, W)).astype(dtype)
+    labels_pred = rng.integers(0, K, (B, H, W)).astype(dtype)
+    # One prediction identical to `label_true` and one mostly identical.
+    labels_pred[0] = label_true
+    labels_pred[1] = np.where(
+        rng.random((H, W)) < 0.8, label_true, labels_pred[1])
+    return label_true, labels_pred
+
+
+@pytest.mark.parametrize('device', ['cpu', 'cpu:0'])
+@pytest.mark.parametrize('dtype', [np.int64, np.int16, np.uint8])
+@pytest.mark.parametrize('shape', [(32, 40), (7, 9), (5, 12), (4, 4)])
+def test_range_aware_ssim_batch(shape, dtype, device):
+    label_true, labels_pred = make_labels(*shape, K=6, dtype=dtype)
+    np.testing.assert_allclose(range_aware_ssim_batch(label_true,
+                                                      labels_pred,
+                                                      device=device),
+                               skimage_ssim_list(label_true, labels_pred),
+                               rtol=1e-9,
+                               atol=1e-12)
+
+
+@pytest.mark.parametrize('device', ['cpu', 'cpu:0'])
+def test_range_aware_ssim_batch_constant_reference(device):
+    _, labels_pred = make_labels(24, 24, K=3, dtype=np.int64)
+    label_true = np.full((24, 24), 2, dtype=np.int64)
+    labels_pred[0] = label_true
+    # A zero data range gives NaN in skimage, which shall be kept.
+    np.testing.assert_allclose(range_aware_ssim_batch(label_true,
+                                                      labels_pred,
+                                                      device=device),
+                               skimage_ssim_list(label_true, labels_pred),
+                               rtol=1e-9,
+                               atol=1e-12,
+                               equal_nan=True)
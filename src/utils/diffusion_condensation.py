@@ -10,7 +10,7 @@ from scipy import sparse
 from scipy.spatial.distance import directed_hausdorff
 from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.preprocessing import normalize
-from utils.metrics import dice_coeff
+from utils.metrics import densify_label, dice_coeff
 
 
 def pos_enc_sinusoid(shape: Tuple[int]) -> np.array:
@@ -217,15 +217,32 @@ def get_persistent_structures(labels: np.array) -> np.array:
     size_diff_tolerance = 1e-2
 
     B, H, W = labels.shape
-    persistent_label = np.zeros((H, W), dtype=np.int16)
-    persistence_tuple = []  # (persistence, size, label_idx, frame_idx)
-
-    for label_idx in np.unique(labels):
+    persistence_tuple = []  # (persistence, size, k, frame_idx)
+
+    # Map the label indices to k in [0, K), and count sizes with histograms:
+    #   `sizes[frame_idx, k]`: size of label k in that frame.
+    #   `overlaps[frame_idx, k]`: size of label k in that frame and the next.
+    # The size of the difference b/w two consecutive frames then follows.
+    # One histogram per frame, such that no extra [B, H * W] array is needed.
+    uniq_labels, inverse = densify_label(labels)
+    inverse = inverse.reshape(B, H * W)
+    K = len(uniq_labels)
+
+    sizes = np.empty((B, K), dtype=np.int64)
+    overlaps = np.empty((B - 1, K), dtype=np.int64)
+    for frame_idx in range(B):
+        sizes[frame_idx] = np.bincount(inverse[frame_idx], minlength=K)
+    for frame_idx in range(B - 1):
+        unchanged = inverse[frame_idx] == inverse[frame_idx + 1]
+        overlaps[frame_idx] = np.bincount(inverse[frame_idx][unchanged],
+                                          minlength=K)
+    diffs = sizes[:-1] + sizes[1:] - 2 * overlaps
+
+    for k in range(K):
         curr_persistence, max_persistence, best_frame = 0, 0, -1
         for frame_idx in range(B - 1):
-            size = np.sum(labels[frame_idx, ...] == label_idx)
-            diff = np.sum((labels[frame_idx, ...] == label_idx) != (
-                labels[frame_idx + 1, ...] == label_idx))
+            size = sizes[frame_idx, k]
+            diff = diffs[frame_idx, k]
             if size > 0 and diff <= size * size_diff_tolerance:
                 curr_persistence += 1
                 if curr_persistence > max_persistence:
@@ -233,15 +250,32 @@ def get_persistent_structures(labels: np.array) -> np.array:
                     best_frame = frame_idx
             else:
                 curr_persistence = 0
-        size = np.sum(labels[best_frame, ...] == label_idx)
-        persistence_tuple.append(
-            (max_persistence, size, label_idx, best_frame))
+        size = sizes[best_frame, k]
+        persistence_tuple.append((max_persistence, size, k, best_frame % B))
 
     persistence_tuple = sorted(persistence_tuple, key=lambda x: (x[0], -x[1]))
 
-    for (persistence, size, label_idx, frame_idx) in persistence_tuple:
-        loc = labels[frame_idx, ...] == label_idx
-        persistent_label[loc] = label_idx
+    # Paint the structures in sorted order, i.e., later ones overwrite earlier.
+    # Each label k is painted from a single frame. So at each pixel, the
+    # candidates are the labels (one per frame) painted from that very frame,
+    # and the last one in sorted order wins.
+    order = np.array([k for (_, _, k, _) in persistence_tuple], dtype=np.int64)
+    rank = np.empty(K, dtype=np.int64)
+    rank[order] = np.arange(K)
+    paint_frame = np.empty(K, dtype=np.int64)
+    for (_, _, k, frame_idx) in persistence_tuple:
+        paint_frame[k] = frame_idx
+
+    # `frame_rank[frame_idx, k]`: rank of label k if painted from that frame.
+    frame_rank = np.where(paint_frame[None, :] == np.arange(B)[:, None],
+                          rank[None, :], -1)
+    winner = np.full(H * W, -1, dtype=np.int64)
+    for frame_idx in range(B):
+        np.maximum(winner,
+                   frame_rank[frame_idx][inverse[frame_idx]],
+                   out=winner)
+    persistent_label = np.where(winner >= 0, uniq_labels[order[winner]],
+                                0).astype(np.int16).reshape(H, W)
 
     return persistent_label
 
@@ -1,7 +1,10 @@
+from typing import Tuple
+
 import numpy as np
 import sewar
 import torch
 import torch.nn.functional as F
+from scipy.ndimage import uniform_filter
 from skimage.metrics import hausdorff_distance, structural_similarity
 from sklearn.metrics import accuracy_score
 
@@ -42,9 +45,87 @@ def range_aware_ssim(label_true: np.array, label_pred: np.array) -> float:
     '''
     data_range = label_true.max() - label_true.min()
 
+    if data_range > 0 and np.array_equal(label_true, label_pred):
+        # Identical inputs, no need to run the sliding windows.
+        return 1.0
+
     return ssim(a=label_true, b=label_pred, data_range=data_range)
 
 
+def range_aware_ssim_batch(label_true: np.array,
+                           labels_pred: np.array,
+                           win_size: int = 7,
+                           K1: float = 0.01,
+                           K2: float = 0.03,
+                           device: str = 'cpu') -> np.array:
+    '''
+    Same as `[range_aware_ssim(label_true, label_pred) for label_pred in labels_pred]`.
+
+    `labels_pred`: [B, H, W] predictions, all compared against the same `label_true`.
+    `device`: if not 'cpu', the whole batch is processed at once with PyTorch on `device`.
+
+    Reimplements the default skimage ssim (uniform window, sample covariance),
+    but filters the local statistics of `label_true` only once for the entire batch.
+    Only the filter-radius-cropped region contributes to the mean, so we skip the rest.
+    '''
+    H, W = label_true.shape
+    assert labels_pred.shape[1:] == (H, W)
+
+    if min(H, W) < win_size:
+        return np.array([
+            range_aware_ssim(label_true=label_true, label_pred=label_pred)
+            for label_pred in labels_pred
+        ])
+
+    data_range = label_true.max() - label_true.min()
+    C1 = (K1 * data_range)**2
+    C2 = (K2 * data_range)**2
+    NP = win_size**2
+    cov_norm = NP / (NP - 1)
+
+    if device != 'cpu':
+        # Average pooling with stride 1 gives the window means of the cropped region.
+        def local_mean(z: torch.Tensor) -> torch.Tensor:
+            return F.avg_pool2d(z, kernel_size=win_size, stride=1)
+
+        # [1, 1, H, W] and [B, 1, H, W].
+        x = torch.from_numpy(label_true.astype(np.float64)).to(device)
+        y = torch.from_numpy(labels_pred.astype(np.float64)).to(device)
+        x, y = x[None, None, ...], y[:, None, ...]
+        ux, uy = local_mean(x), local_mean(y)
+        vx = cov_norm * (local_mean(x * x) - ux * ux)
+        vy = cov_norm * (local_mean(y * y) - uy * uy)
+        vxy = cov_norm * (local_mean(x * y) - ux * uy)
+
+        S = ((2 * ux * uy + C1) * (2 * vxy + C2)) / \
+            ((ux**2 + uy**2 + C1) * (vx + vy + C2))
+        return S.mean(dim=(1, 2, 3)).cpu().numpy()
+
+    pad = (win_size - 1) // 2
+    crop = (slice(pad, H - pad), slice(pad, W - pad))
+
+    x = label_true.astype(np.float64)
+    ux = uniform_filter(x, size=win_size)[crop]
+    vx = cov_norm * (uniform_filter(x * x, size=win_size)[crop] - ux * ux)
+
+    ssim_list = []
+    for label_pred in labels_pred:
+        if data_range > 0 and np.array_equal(label_true, label_pred):
+            ssim_list.append(1.0)
+            continue
+
+        y = label_pred.astype(np.float64)
+        uy = uniform_filter(y, size=win_size)[crop]
+        vy = cov_norm * (uniform_filter(y * y, size=win_size)[crop] - uy * uy)
+        vxy = cov_norm * (uniform_filter(x * y, size=win_size)[crop] - ux * uy)
+
+        S = ((2 * ux * uy + C1) * (2 * vxy + C2)) / \
+            ((ux**2 + uy**2 + C1) * (vx + vy + C2))
+        ssim_list.append(S.mean(dtype=np.float64))
+
+    return np.array(ssim_list)
+
+
 def ergas(a: np.array, b: np.array) -> float:
     return sewar.full_ref.ergas(a, b)
 
@@ -53,6 +134,31 @@ def rmse(a: np.array, b: np.array) -> float:
     return sewar.full_ref.rmse(a, b)
 
 
+def rmse_ergas(a: np.array,
+               b: np.array,
+               r: float = 0.25) -> Tuple[float, float]:
+    '''
+    Same as (`rmse(a, b)`, `ergas(a, b)`), following `sewar.full_ref`.
+
+    Both metrics only need the per-band mean squared error,
+    so we compute the squared difference in a single pass and share it.
+    '''
+    assert a.shape == b.shape
+
+    if len(a.shape) == 2:
+        a = a[:, :, None]
+        b = b[:, :, None]
+
+    a = a.astype(np.float64)
+    mse_per_band = ((a - b.astype(np.float64))**2).mean(axis=(0, 1))
+    mean_per_band = a.mean(axis=(0, 1))
+
+    rmse_value = np.sqrt(mse_per_band.mean())
+    ergas_value = 100 * r * np.sqrt(np.mean(mse_per_band / mean_per_band**2))
+
+    return rmse_value, ergas_value
+
+
 def dice_coeff(label_pred: np.array, label_true: np.array) -> float:
     intersection = np.logical_and(label_pred, label_true).sum()
     dice = (2 * intersection) / (label_pred.sum() + label_true.sum())
@@ -126,37 +232,80 @@ def recon_ssim(x: torch.Tensor, x_recon: torch.Tensor) -> float:
     return np.mean(ssim_list)
 
 
-def guided_relabel(label_pred: np.array, label_true: np.array) -> np.array:
+def densify_label(label: np.array) -> Tuple[np.array, np.array]:
+    '''
+    Same as `np.unique(label, return_inverse=True)`, with the inverse flattened.
+
+    For non-negative integer labels, a histogram over the label indices
+    replaces the sort in `np.unique`, so this takes linear time.
+    Boolean labels are not indices and take the `np.unique` path.
+    '''
+    label = label.reshape(-1)
+
+    if label.size > 0 and np.issubdtype(label.dtype, np.integer) \
+            and np.can_cast(label.dtype, np.intp) \
+            and label.min() >= 0 and label.max() < label.size:
+        counts = np.bincount(label)
+        uniq = np.flatnonzero(counts)
+        lookup = np.zeros(len(counts), dtype=np.intp)
+        lookup[uniq] = np.arange(len(uniq))
+        return uniq.astype(label.dtype), lookup[label]
+
+    uniq, inverse = np.unique(label, return_inverse=True)
+    return uniq, inverse.reshape(-1)
+
+
+def guided_relabel(
+        label_pred: np.array,
+        label_true: np.array,
+        label_true_dense: Tuple[np.array, np.array] = None) -> np.array:
     '''
     Relabel (i.e., update label index) `label_pred` such that it best matches `label_true`.
 
-    For each label index, assign an one-hot vector (flattened pixel values),
-    and compute the IOU among each pair of such one-hot vectors b/w `label_pred` and `label_true`.
+    Count the co-occurrence of each pair of label indices b/w `label_pred` and `label_true`
+    (i.e., the confusion matrix), and use it to compute the IOU among each pair.
+
+    `label_true_dense`: optional `densify_label(label_true)`, to be reused when
+                        relabeling several predictions against the same `label_true`.
     '''
     assert label_pred.shape == label_true.shape
     H, W = label_pred.shape
 
-    label_pred_vec = np.array(
-        [label_pred.reshape(H * W) == i for i in np.unique(label_pred)],
-        dtype=np.int16)
-    label_true_vec = np.array(
-        [label_true.reshape(H * W) == i for i in np.unique(label_true)],
-        dtype=np.int16)
+    if label_true_dense is None:
+        label_true_dense = densify_label(label_true)
+    uniq_true, true_inverse = label_true_dense
+
+    if len(uniq_true) == 1:
+        # Every index in `label_pred` can only be matched to this one index.
+        return np.full_like(label_pred, uniq_true[0])
+
+    uniq_pred, pred_inverse = densify_label(label_pred)
+    K_pred, K_true = len(uniq_pred), len(uniq_true)
+
+    if K_pred == 1:
+        # The IOU with a full-image label is proportional to the other area.
+        # Hence, the best match is simply the most frequent `label_true` index.
+        return np.full_like(label_pred,
+                            uniq_true[np.argmax(np.bincount(true_inverse))])
 
-    # Use matrix multiplication to get intersection matrix.
-    intersection_matrix = np.matmul(label_pred_vec, label_true_vec.T)
+    # Confusion matrix, i.e., the intersection matrix, from one joint histogram.
+    intersection_matrix = np.bincount(pred_inverse * K_true + true_inverse,
+                                      minlength=K_pred * K_true).reshape(
+                                          K_pred, K_true)
 
-    # Use matrix multiplication to get union matrix.
-    union_matrix = H * W - np.matmul(1 - label_pred_vec,
-                                     (1 - label_true_vec).T)
+    # |A U B| = |A| + |B| - |A n B|.
+    area_pred = intersection_matrix.sum(axis=1)
+    area_true = intersection_matrix.sum(axis=0)
+    union_matrix = area_pred[:, None] + area_true[None, :] - intersection_matrix
 
     iou_matrix = intersection_matrix / union_matrix
 
-    renumbered_label_pred = np.zeros_like(label_pred)
+    # Best matching `label_true` index for each `label_pred` index.
+    best_true_idx = uniq_true[np.argmax(iou_matrix, axis=1)]
 
-    for i, label_pred_idx in enumerate(np.unique(label_pred)):
-        pix_loc = label_pred == label_pred_idx
-        label_true_idx = np.unique(label_true)[np.argmax(iou_matrix[i, :])]
-        renumbered_label_pred[pix_loc] = label_true_idx
+    # `pred_inverse` holds the position of each pixel's index in `uniq_pred`,
+    # so a single gather renumbers the entire image.
+    renumbered_label_pred = best_true_idx[pred_inverse].reshape(H, W).astype(
+        label_pred.dtype)
 
-    return renumbered_label_pred
\ No newline at end of file
+    return renumbered_label_pred